@@ -8,9 +8,11 @@ from werkzeug.utils import secure_filename
 import datetime
 import re
 import csv
+import replication
 # ========== SETTINGS ==========
 UPLOAD_FOLDER = 'uploads'
 DB_NAME = 'patterns-matter.db'
+DRIVE_MUSIC_CSV = '/data/drive_music.csv'
 ADMIN_PASSWORD = 'IronMa1deN!'
 
 ALLOWED_DATASET_EXTENSIONS = {'csv', 'npy'}
@@ -421,7 +423,7 @@ def public_clips():
     clips = []
 
     # -- 1. Try to load from CSV (Drive-backed music list)
-    csv_path = '/data/drive_music.csv'
+    csv_path = DRIVE_MUSIC_CSV
     #csv_path = '/data/drive_music.csv' if os.path.exists('/data/drive_music.csv') else 'drive_music.csv'
 
     try:
@@ -612,7 +614,7 @@ def add_drive_clip():
             preview_url = f"https://drive.google.com/file/d/{file_id}/preview"
             download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
             try:
-                with open('/data/drive_music.csv', 'a', newline='', encoding='utf-8') as f:
+                with open(DRIVE_MUSIC_CSV, 'a', newline='', encoding='utf-8') as f:
                     writer = csv.writer(f)
                     writer.writerow([title, description, preview_url, download_url])
                 message = "✅ Clip added successfully!"
@@ -628,9 +630,12 @@ def add_drive_clip():
 for rule in app.url_map.iter_rules():
     print(rule.endpoint, rule)
 
-auto_import_uploads()
-auto_log_material_files()
+# Replicas get the database and uploads from the primary's snapshots instead
+if replication.ROLE != 'replica':
+    auto_import_uploads()
+    auto_log_material_files()
+replication.init_app(app, DB_NAME, UPLOAD_FOLDER, DRIVE_MUSIC_CSV)
 
 # ========== MAIN ==========
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file
@@ -0,0 +1,498 @@
+# Primary/replica snapshots of the SQLite database, uploads/ and the clips CSV
+#
+# The primary (the machine the admin writes to) publishes consistent snapshots
+# into a snapshot directory:
+#
+#   objects/<sha[:2]>/<sha>     content-addressed copies of the database, clips CSV and uploads
+#   manifests/<generation>.json which object is which file
+#   CURRENT                     the latest generation number and the manifest's sha256
+#
+# Only new or changed files are copied into objects/, so each publish is
+# incremental. Replicas pull from the same directory (shared folder) or from
+# the primary's /replication/ endpoint, verify every object against its
+# sha256 and atomically swap the files in place. Writes, and every request of
+# a logged-in admin, are sent on to the primary.
+import os
+import json
+import hmac
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import contextlib
+import datetime
+import urllib.request
+
+try:
+    import fcntl  # not available on Windows; locking then only covers this process
+except ImportError:
+    fcntl = None
+
+# ========== SETTINGS ==========
+ROLES = {'standalone', 'primary', 'replica'}
+# On Fly every machine shares one [env]; set PM_PRIMARY_INSTANCE to the primary's
+# machine ID and each machine derives its own role from FLY_MACHINE_ID.
+FLY_MACHINE_ID = os.environ.get('FLY_MACHINE_ID', '')
+FLY_APP_NAME = os.environ.get('FLY_APP_NAME', '')
+PRIMARY_INSTANCE = os.environ.get('PM_PRIMARY_INSTANCE', '')
+if 'PM_ROLE' in os.environ:
+    ROLE = os.environ['PM_ROLE'].lower()
+elif PRIMARY_INSTANCE and FLY_MACHINE_ID:
+    ROLE = 'primary' if FLY_MACHINE_ID == PRIMARY_INSTANCE else 'replica'
+else:
+    ROLE = 'standalone'
+if ROLE not in ROLES:
+    raise RuntimeError(f"Unknown PM_ROLE '{ROLE}' (expected standalone, primary or replica).")
+
+# primary: where snapshots are published (kept on the volume, outside the app directory)
+SNAPSHOT_DIR = os.environ.get('PM_SNAPSHOT_DIR', '/data/snapshots' if os.path.isdir('/data') else 'snapshots')
+# replica: shared directory or http(s) URL; on Fly defaults to the primary over the private network
+SNAPSHOT_SOURCE = os.environ.get('PM_SNAPSHOT_SOURCE', '')
+if not SNAPSHOT_SOURCE and PRIMARY_INSTANCE and FLY_APP_NAME:
+    SNAPSHOT_SOURCE = f"http://{PRIMARY_INSTANCE}.vm.{FLY_APP_NAME}.internal:8080/replication"
+PRIMARY_URL = os.environ.get('PM_PRIMARY_URL', '').rstrip('/')       # replica: where writes are redirected off Fly
+REPLICATION_TOKEN = os.environ.get('PM_REPLICATION_TOKEN', '')       # required to serve /replication/
+PUBLISH_INTERVAL = float(os.environ.get('PM_PUBLISH_INTERVAL', 60))
+SYNC_INTERVAL = float(os.environ.get('PM_SYNC_INTERVAL', 30))
+KEEP_MANIFESTS = int(os.environ.get('PM_KEEP_MANIFESTS', 5))
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+# The Fly proxy does not replay request bodies larger than this
+REPLAY_BODY_LIMIT = 1024 * 1024
+# GET routes that still write to the database
+WRITE_ENDPOINTS = {'migrate_csv_to_db'}
+
+CHUNK_SIZE = 1024 * 1024
+
+_thread_lock = threading.Lock()
+_publish_requested = threading.Event()
+_replica_ready = threading.Event()
+# relpath -> (size, mtime_ns, sha256) so unchanged uploads are not re-hashed
+_upload_hashes = {}
+
+
+# ---------- Utility Functions ----------
+@contextlib.contextmanager
+def _locked(lock_path):
+    with _thread_lock:
+        with open(lock_path, 'a') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+def _object_relpath(digest):
+    return f"objects/{digest[:2]}/{digest}"
+
+def _manifest_relpath(generation):
+    return f"manifests/{generation:012d}.json"
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _copy_hashing(src, dst):
+    """Copy file object src into file object dst, return (sha256, size)."""
+    h = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+        h.update(chunk)
+        dst.write(chunk)
+        size += len(chunk)
+    return h.hexdigest(), size
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _read_json(path, default):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def _local_path(root, relpath):
+    """Join a manifest path onto root, refusing anything that escapes it."""
+    root = os.path.abspath(root)
+    path = os.path.abspath(os.path.join(root, *relpath.split('/')))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Unsafe path in manifest: {relpath}")
+    return path
+
+
+# ========== PRIMARY: PUBLISH ==========
+def _store_object(snapshot_dir, src_path):
+    """Copy a file into the object store (if not there yet), return (sha256, size)."""
+    objects_dir = os.path.join(snapshot_dir, 'objects')
+    fd, tmp = tempfile.mkstemp(dir=objects_dir, prefix='.tmp-')
+    try:
+        with open(src_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            digest, size = _copy_hashing(src, dst)
+        final = os.path.join(snapshot_dir, _object_relpath(digest))
+        if os.path.exists(final):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            os.replace(tmp, final)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return digest, size
+
+def _store_upload(snapshot_dir, upload_folder, relpath):
+    path = _local_path(upload_folder, relpath)
+    st = os.stat(path)
+    cached = _upload_hashes.get(relpath)
+    if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+        digest = cached[2]
+        if os.path.exists(os.path.join(snapshot_dir, _object_relpath(digest))):
+            return digest, st.st_size
+    digest, size = _store_object(snapshot_dir, path)
+    _upload_hashes[relpath] = (st.st_size, st.st_mtime_ns, digest)
+    return digest, size
+
+def _manifest_digests(manifest):
+    yield manifest['db']['sha256']
+    if manifest.get('clips'):
+        yield manifest['clips']['sha256']
+    for entry in manifest['uploads'].values():
+        yield entry['sha256']
+
+def _read_current(f):
+    """Parse CURRENT: '<generation> <sha256 of the manifest>'."""
+    parts = f.read().split()
+    if isinstance(parts[0], bytes):
+        parts = [p.decode('utf-8') for p in parts]
+    return int(parts[0]), (parts[1] if len(parts) > 1 else '')
+
+def _prune(snapshot_dir, current):
+    """Keep the newest KEEP_MANIFESTS manifests and the objects they reference."""
+    manifests_dir = os.path.join(snapshot_dir, 'manifests')
+    names = sorted(n for n in os.listdir(manifests_dir) if n.endswith('.json'))
+    keep = names[-max(KEEP_MANIFESTS, 1):]
+    for name in names:
+        if name not in keep:
+            os.remove(os.path.join(manifests_dir, name))
+
+    referenced = set()
+    for name in keep:
+        manifest = _read_json(os.path.join(manifests_dir, name), None)
+        if manifest is None:
+            continue
+        referenced.update(_manifest_digests(manifest))
+    referenced.update(_manifest_digests(current))
+
+    objects_dir = os.path.join(snapshot_dir, 'objects')
+    for root, dirs, files in os.walk(objects_dir):
+        for filename in files:
+            if not filename.startswith('.tmp-') and filename not in referenced:
+                os.remove(os.path.join(root, filename))
+
+def publish_snapshot(db_path, upload_folder, clips_csv=None, snapshot_dir=SNAPSHOT_DIR):
+    """Publish the database, uploads and the clips CSV into snapshot_dir.
+
+    Returns the generation now in CURRENT; no new generation is written when
+    nothing changed since the last publish.
+    """
+    os.makedirs(os.path.join(snapshot_dir, 'objects'), exist_ok=True)
+    os.makedirs(os.path.join(snapshot_dir, 'manifests'), exist_ok=True)
+
+    with _locked(os.path.join(snapshot_dir, '.lock')):
+        # Online backup API: a consistent copy even while requests keep writing
+        fd, tmp_db = tempfile.mkstemp(dir=snapshot_dir, prefix='.tmp-', suffix='.db')
+        os.close(fd)
+        try:
+            with contextlib.closing(sqlite3.connect(db_path)) as src, \
+                    contextlib.closing(sqlite3.connect(tmp_db)) as dst:
+                src.backup(dst)
+                # Replicas swap the file in as-is, so it must not depend on a -wal file
+                dst.execute("PRAGMA journal_mode=DELETE")
+            db_digest, db_size = _store_object(snapshot_dir, tmp_db)
+        finally:
+            if os.path.exists(tmp_db):
+                os.remove(tmp_db)
+
+        uploads = {}
+        if os.path.exists(upload_folder):
+            for root, dirs, files in os.walk(upload_folder):
+                for filename in files:
+                    rel_path = os.path.relpath(os.path.join(root, filename), upload_folder)
+                    rel_path = rel_path.replace(os.sep, '/')
+                    try:
+                        digest, size = _store_upload(snapshot_dir, upload_folder, rel_path)
+                    except FileNotFoundError:
+                        continue  # deleted while we were walking
+                    uploads[rel_path] = {'sha256': digest, 'size': size}
+
+        # /clips reads the Drive-backed CSV straight from disk, so it travels too
+        clips = None
+        if clips_csv and os.path.isfile(clips_csv):
+            clips_digest, clips_size = _store_object(snapshot_dir, clips_csv)
+            clips = {'sha256': clips_digest, 'size': clips_size}
+
+        manifest = {
+            'db': {'sha256': db_digest, 'size': db_size},
+            'clips': clips,
+            'uploads': uploads,
+        }
+
+        current_path = os.path.join(snapshot_dir, 'CURRENT')
+        generation = 0
+        if os.path.exists(current_path):
+            with open(current_path, encoding='utf-8') as f:
+                generation, _ = _read_current(f)
+            previous = _read_json(os.path.join(snapshot_dir, _manifest_relpath(generation)), {})
+            if all(previous.get(key) == manifest[key] for key in ('db', 'clips', 'uploads')):
+                return generation
+
+        generation += 1
+        manifest['generation'] = generation
+        manifest['created_at'] = datetime.datetime.now().isoformat()
+        data = json.dumps(manifest, indent=1, sort_keys=True)
+        manifest_digest = hashlib.sha256(data.encode('utf-8')).hexdigest()
+        _write_atomic(os.path.join(snapshot_dir, _manifest_relpath(generation)), data)
+        # The digest lets replicas notice a recreated snapshot dir that restarted at 1
+        _write_atomic(current_path, f"{generation} {manifest_digest}\n")
+        _prune(snapshot_dir, manifest)
+
+    print(f"Published snapshot generation {generation} ({len(uploads)} uploads).")
+    return generation
+
+
+# ========== REPLICA: SYNC ==========
+def _open_source(source, relpath):
+    if source.startswith(('http://', 'https://')):
+        req = urllib.request.Request(f"{source.rstrip('/')}/{relpath}")
+        if REPLICATION_TOKEN:
+            req.add_header('X-Replication-Token', REPLICATION_TOKEN)
+        return urllib.request.urlopen(req, timeout=60)
+    return open(os.path.join(source, *relpath.split('/')), 'rb')
+
+def _read_manifest(source, generation, digest):
+    with _open_source(source, _manifest_relpath(generation)) as f:
+        data = f.read()
+    if digest and hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f"Checksum mismatch for manifest {generation}")
+    return json.loads(data.decode('utf-8'))
+
+def _fetch_object(source, digest, dest_path):
+    """Download an object next to dest_path and verify it; return the temp path."""
+    dest_dir = os.path.dirname(dest_path) or '.'
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dest_dir, prefix='.tmp-')
+    try:
+        with _open_source(source, _object_relpath(digest)) as src, os.fdopen(fd, 'wb') as dst:
+            got, size = _copy_hashing(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        if got != digest:
+            raise ValueError(f"Checksum mismatch for object {digest} (got {got})")
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return tmp
+
+def _check_database(path):
+    with contextlib.closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    if result != 'ok':
+        raise ValueError(f"Snapshot database failed integrity check: {result}")
+
+def sync_from_snapshot(db_path, upload_folder, clips_csv=None, source=SNAPSHOT_SOURCE):
+    """Pull the latest snapshot from source and swap it in.
+
+    Every changed file is fetched and verified before anything is replaced,
+    so a bad object leaves the replica as it was. Uploads are swapped in
+    before the database so the new database never references a file that is
+    not there yet; files the primary deleted are removed last. Returns True
+    if a new generation was applied.
+    """
+    state_path = db_path + '.replica.json'
+    with _locked(db_path + '.sync.lock'):
+        state = _read_json(state_path, {})
+        with _open_source(source, 'CURRENT') as f:
+            generation, manifest_digest = _read_current(f)
+        if (generation == state.get('generation') and manifest_digest == state.get('manifest')
+                and os.path.exists(db_path)):
+            return False
+
+        manifest = _read_manifest(source, generation, manifest_digest)
+        applied_uploads = state.get('uploads', {})
+
+        # 1. Fetch and verify: (temp file, final path) pairs, in swap order
+        staged = []
+        try:
+            for rel_path, entry in manifest['uploads'].items():
+                local = _local_path(upload_folder, rel_path)
+                if os.path.isfile(local):
+                    if applied_uploads.get(rel_path) == entry['sha256']:
+                        continue
+                    if _sha256_file(local) == entry['sha256']:
+                        continue
+                staged.append((_fetch_object(source, entry['sha256'], local), local))
+            fetched = len(staged)
+
+            clips = manifest.get('clips')
+            if clips_csv and clips and (state.get('clips') != clips['sha256'] or not os.path.isfile(clips_csv)):
+                staged.append((_fetch_object(source, clips['sha256'], os.path.abspath(clips_csv)), clips_csv))
+
+            db_entry = manifest['db']
+            if state.get('db') != db_entry['sha256'] or not os.path.exists(db_path):
+                tmp = _fetch_object(source, db_entry['sha256'], os.path.abspath(db_path))
+                staged.append((tmp, db_path))
+                _check_database(tmp)
+        except BaseException:
+            for tmp, _ in staged:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            raise
+
+        # 2. Swap in; open connections keep reading the old database file
+        for tmp, final in staged:
+            os.replace(tmp, final)
+
+        # 3. Files the primary no longer has
+        for rel_path in applied_uploads:
+            if rel_path not in manifest['uploads']:
+                local = _local_path(upload_folder, rel_path)
+                if os.path.isfile(local):
+                    os.remove(local)
+        if clips_csv and not clips and state.get('clips') and os.path.isfile(clips_csv):
+            os.remove(clips_csv)
+
+        _write_atomic(state_path, json.dumps({
+            'generation': generation,
+            'manifest': manifest_digest,
+            'db': db_entry['sha256'],
+            'clips': clips['sha256'] if clips else None,
+            'uploads': {p: e['sha256'] for p, e in manifest['uploads'].items()},
+        }))
+
+    print(f"Applied snapshot generation {generation} ({fetched} uploads fetched).")
+    return True
+
+
+# ========== BACKGROUND THREADS ==========
+def request_publish():
+    _publish_requested.set()
+
+def _publish_loop(db_path, upload_folder, clips_csv):
+    while True:
+        _publish_requested.wait(PUBLISH_INTERVAL)
+        _publish_requested.clear()
+        try:
+            publish_snapshot(db_path, upload_folder, clips_csv)
+        except Exception as e:
+            print(f"Failed to publish snapshot: {e}")
+
+def _sync_loop(db_path, upload_folder, clips_csv):
+    while True:
+        try:
+            sync_from_snapshot(db_path, upload_folder, clips_csv)
+            _replica_ready.set()
+        except Exception as e:
+            print(f"Failed to sync snapshot: {e}")
+        time.sleep(SYNC_INTERVAL)
+
+
+# ========== FLASK WIRING ==========
+def _is_write(request):
+    return request.method not in SAFE_METHODS or request.endpoint in WRITE_ENDPOINTS
+
+def _for_primary(request, session):
+    # Admins are sent to the primary for every request so they read their own writes
+    return _is_write(request) or session.get('admin', False)
+
+def init_app(app, db_path, upload_folder, clips_csv=None):
+    """Hook replication into the app according to PM_ROLE."""
+    from flask import request, session, redirect, abort, send_from_directory
+
+    if ROLE == 'primary':
+        snapshot_dir = os.path.abspath(SNAPSHOT_DIR)
+
+        @app.after_request
+        def publish_after_write(response):
+            if _is_write(request) and response.status_code < 400:
+                request_publish()
+            return response
+
+        # Lets replicas on other machines pull over HTTP. Refused unless a token is
+        # configured, since the snapshots contain the whole database.
+        @app.route('/replication/<path:filename>')
+        def replication_file(filename):
+            token = request.headers.get('X-Replication-Token', '')
+            if not REPLICATION_TOKEN or not hmac.compare_digest(token, REPLICATION_TOKEN):
+                abort(403)
+            # Hides .lock and in-flight objects/.tmp-* files
+            if any(part.startswith('.') for part in filename.split('/')):
+                abort(404)
+            return send_from_directory(snapshot_dir, filename, max_age=0)
+
+        request_publish()
+        threading.Thread(target=_publish_loop, args=(db_path, upload_folder, clips_csv),
+                         name='snapshot-publisher', daemon=True).start()
+
+    elif ROLE == 'replica':
+        if not SNAPSHOT_SOURCE:
+            raise RuntimeError("PM_ROLE=replica needs PM_SNAPSHOT_SOURCE (shared directory or URL).")
+
+        # A restarted replica can serve its last applied snapshot right away
+        if os.path.exists(db_path) and _read_json(db_path + '.replica.json', {}).get('generation'):
+            _replica_ready.set()
+
+        @app.before_request
+        def redirect_writes():
+            if _for_primary(request, session):
+                if PRIMARY_INSTANCE and FLY_MACHINE_ID:
+                    if (request.content_length or 0) > REPLAY_BODY_LIMIT:
+                        return ("Uploads over 1 MB cannot be forwarded to the primary; upload through "
+                                f"{PRIMARY_INSTANCE}.vm.{FLY_APP_NAME}.internal (fly proxy) instead."), 413
+                    # All machines share one hostname on Fly; let the proxy replay the request on the primary
+                    return "", 409, {'fly-replay': f"instance={PRIMARY_INSTANCE}"}
+                if not PRIMARY_URL:
+                    return "Read-only replica: writes are not accepted here.", 503
+                # 307 keeps the method and body of the original request
+                return redirect(PRIMARY_URL + request.full_path.rstrip('?'), code=307)
+            # Until the first snapshot is in place only the landing page (health check) is served
+            if not _replica_ready.is_set() and request.endpoint not in ('public_home', 'static'):
+                return "Replica is still fetching its first snapshot, try again shortly.", 503
+            return None
+
+        threading.Thread(target=_sync_loop, args=(db_path, upload_folder, clips_csv),
+                         name='snapshot-sync', daemon=True).start()
+
+
+# ========== MAIN ==========
+if __name__ == '__main__':
+    # python replication.py publish|sync  -- one-off publish or sync using the PM_* settings
+    import sys
+    DB_NAME = 'patterns-matter.db'
+    UPLOAD_FOLDER = 'uploads'
+    DRIVE_MUSIC_CSV = '/data/drive_music.csv'
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'publish':
+        publish_snapshot(DB_NAME, UPLOAD_FOLDER, DRIVE_MUSIC_CSV)
+    elif command == 'sync':
+        sync_from_snapshot(DB_NAME, UPLOAD_FOLDER, DRIVE_MUSIC_CSV)
+    else:
+        print("Usage: python replication.py publish|sync")
+        sys.exit(2)
@@ -0,0 +1,125 @@
+import os
+import json
+import sqlite3
+
+import pytest
+
+import replication
+
+
+def make_primary(root):
+    primary = root / 'primary'
+    (primary / 'uploads' / 'bandgap' / 'dataset').mkdir(parents=True)
+    db = primary / 'patterns-matter.db'
+    with sqlite3.connect(db) as conn:
+        conn.execute("CREATE TABLE uploads_log (property TEXT, tab TEXT, filename TEXT)")
+        conn.execute("INSERT INTO uploads_log VALUES ('bandgap', 'dataset', 'a.csv')")
+    (primary / 'uploads' / 'bandgap' / 'dataset' / 'a.csv').write_text('x,y\n1,2\n')
+    (primary / 'uploads' / 'bandgap' / 'dataset' / 'b.csv').write_text('x,y\n3,4\n')
+    (primary / 'drive_music.csv').write_text('title,description,preview_url,download_url\n')
+    return primary
+
+
+@pytest.fixture
+def setup(tmp_path):
+    primary = make_primary(tmp_path)
+    replica = tmp_path / 'replica'
+    replica.mkdir()
+    snapshots = str(tmp_path / 'snapshots')
+
+    def publish():
+        return replication.publish_snapshot(
+            str(primary / 'patterns-matter.db'), str(primary / 'uploads'),
+            str(primary / 'drive_music.csv'), snapshot_dir=snapshots)
+
+    def sync():
+        return replication.sync_from_snapshot(
+            str(replica / 'patterns-matter.db'), str(replica / 'uploads'),
+            str(replica / 'drive_music.csv'), source=snapshots)
+
+    return primary, replica, snapshots, publish, sync
+
+
+def test_publish_then_sync_reproduces_rows_and_files(setup):
+    primary, replica, snapshots, publish, sync = setup
+    publish()
+    assert sync() is True
+
+    with sqlite3.connect(replica / 'patterns-matter.db') as conn:
+        rows = conn.execute("SELECT * FROM uploads_log").fetchall()
+    assert rows == [('bandgap', 'dataset', 'a.csv')]
+    dataset = replica / 'uploads' / 'bandgap' / 'dataset'
+    assert sorted(os.listdir(dataset)) == ['a.csv', 'b.csv']
+    assert (dataset / 'a.csv').read_text() == 'x,y\n1,2\n'
+    assert (replica / 'drive_music.csv').read_text() == (primary / 'drive_music.csv').read_text()
+    assert sync() is False
+
+
+def test_publish_without_changes_keeps_generation(setup):
+    primary, replica, snapshots, publish, sync = setup
+    generation = publish()
+    assert publish() == generation
+    (primary / 'drive_music.csv').write_text('title,description,preview_url,download_url\nt,d,p,u\n')
+    assert publish() == generation + 1
+
+
+def test_deleted_file_is_removed_on_replica(setup):
+    primary, replica, snapshots, publish, sync = setup
+    publish()
+    sync()
+    os.remove(primary / 'uploads' / 'bandgap' / 'dataset' / 'b.csv')
+    publish()
+    assert sync() is True
+    assert os.listdir(replica / 'uploads' / 'bandgap' / 'dataset') == ['a.csv']
+
+
+def test_corrupted_object_leaves_replica_untouched(setup):
+    primary, replica, snapshots, publish, sync = setup
+    publish()
+    sync()
+    before = (replica / 'patterns-matter.db').read_bytes()
+
+    (primary / 'uploads' / 'bandgap' / 'dataset' / 'a.csv').write_text('x,y\n9,9\n')
+    with sqlite3.connect(primary / 'patterns-matter.db') as conn:
+        conn.execute("INSERT INTO uploads_log VALUES ('bandgap', 'dataset', 'c.csv')")
+    generation = publish()
+    with open(os.path.join(snapshots, 'CURRENT')) as f:
+        assert int(f.read().split()[0]) == generation
+    with open(os.path.join(snapshots, replication._manifest_relpath(generation))) as f:
+        manifest = json.load(f)
+    digest = manifest['uploads']['bandgap/dataset/a.csv']['sha256']
+    with open(os.path.join(snapshots, replication._object_relpath(digest)), 'ab') as f:
+        f.write(b'junk')
+
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        sync()
+    dataset = replica / 'uploads' / 'bandgap' / 'dataset'
+    assert (dataset / 'a.csv').read_text() == 'x,y\n1,2\n'
+    assert (replica / 'patterns-matter.db').read_bytes() == before
+    assert not [name for name in os.listdir(dataset) if name.startswith('.tmp-')]
+
+
+def test_recreated_snapshot_dir_is_applied(setup):
+    primary, replica, snapshots, publish, sync = setup
+    publish()
+    sync()
+    for root, dirs, files in os.walk(snapshots, topdown=False):
+        for name in files:
+            os.remove(os.path.join(root, name))
+        for name in dirs:
+            os.rmdir(os.path.join(root, name))
+    with sqlite3.connect(primary / 'patterns-matter.db') as conn:
+        conn.execute("INSERT INTO uploads_log VALUES ('bandgap', 'dataset', 'c.csv')")
+    assert publish() == 1
+    assert sync() is True
+    with sqlite3.connect(replica / 'patterns-matter.db') as conn:
+        assert conn.execute("SELECT count(*) FROM uploads_log").fetchone()[0] == 2
+
+
+def test_local_path_rejects_escaping_paths(tmp_path):
+    with pytest.raises(ValueError):
+        replication._local_path(str(tmp_path), '../outside.csv')
+    with pytest.raises(ValueError):
+        replication._local_path(str(tmp_path), 'bandgap/../../outside.csv')
+    assert replication._local_path(str(tmp_path), 'bandgap/dataset/a.csv') == \
+        os.path.join(str(tmp_path), 'bandgap', 'dataset', 'a.csv')